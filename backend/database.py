@@ -10,20 +10,35 @@ load_dotenv()
 
 POOL = None
 
+# Pool sizing: every in-flight chat request holds a connection, so a pool
+# of 5 capped concurrency at 5 regardless of server load. Default to
+# scaling with the machine (driver maximum is 32); set DB_POOL_SIZE to
+# roughly 2 x the expected number of concurrent chats.
+DEFAULT_POOL_SIZE = min(32, (os.cpu_count() or 4) * 4)
+
+
 def init_pool():
     global POOL
     if POOL is None:
         try:
+            pool_size = int(os.getenv("DB_POOL_SIZE", str(DEFAULT_POOL_SIZE)))
             POOL = MySQLConnectionPool(
                 pool_name="ken_pool",
-                pool_size=int(os.getenv("DB_POOL_SIZE", "5")),
+                pool_size=pool_size,
                 host=os.getenv("DB_HOST", "localhost"),
                 port=int(os.getenv("DB_PORT", "3306")),
                 database=os.getenv("DB_NAME", "local_ai_assistant"),
                 user=os.getenv("DB_USER", "root"),
-                password=os.getenv("DB_PASSWORD", "")
+                password=os.getenv("DB_PASSWORD", ""),
+                use_pure=False,           # C-extension driver: faster parse/convert
+                # Skipping the per-checkout session reset is only safe with
+                # autocommit on: otherwise read-only endpoints return
+                # connections with an open transaction, and the next
+                # checkout reads from that stale REPEATABLE READ snapshot.
+                autocommit=True,
+                pool_reset_session=False
             )
-            print("[DB] Connection Pool Initialized")
+            print(f"[DB] Connection Pool Initialized (size={pool_size})")
         except Error as e:
             print(f"[DB] Pool initialization error: {e}")
             POOL = None
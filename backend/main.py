@@ -1,15 +1,18 @@
 # main.py - Final corrected version (Use gemma3:12b)
 import os
 import json
-import re
 import time
-from typing import Optional
+import asyncio
+import threading
+
+import bcrypt
+from cachetools import TTLCache
 
 from fastapi import FastAPI, HTTPException, Depends, Request
-from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse, StreamingResponse
 from pydantic import BaseModel
 import httpx
+import orjson
 from jose import jwt
 from dotenv import load_dotenv
 from jose import JWTError, ExpiredSignatureError
@@ -18,20 +21,75 @@ from jose import JWTError, ExpiredSignatureError
 load_dotenv()
 
 # local project imports
+from mysql.connector import IntegrityError
 from database import get_db_connection
 from auth import create_access_token, SECRET_KEY, ALGORITHM
-from weather import get_weather_summary_for_prompt
+from weather import get_weather_summary_for_prompt, init_http_client, close_http_client
+from text_utils import extract_location, is_weather_followup, generate_chat_title
+
+class PureASGICORS:
+    """
+    Minimal pure-ASGI CORS layer for a single trusted origin.
+    Answers OPTIONS preflights inline and appends the CORS headers to
+    other responses by wrapping send(), so the /chat/stream response body
+    passes through untouched (no per-request middleware task like
+    BaseHTTPMiddleware would add).
+    """
+
+    def __init__(self, app, origin: str = "http://localhost:8080"):
+        self.app = app
+        origin_b = origin.encode()
+        self._cors_headers = [
+            (b"access-control-allow-origin", origin_b),
+            (b"access-control-allow-credentials", b"true"),
+        ]
+        self._preflight_headers = self._cors_headers + [
+            (b"access-control-allow-methods", b"GET, POST, PUT, DELETE, OPTIONS"),
+            (b"access-control-max-age", b"600"),
+        ]
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if scope["method"] == "OPTIONS":
+            # Echo the requested headers: a wildcard is not valid with
+            # credentialed requests.
+            req_headers = b"*"
+            for name, value in scope.get("headers", []):
+                if name == b"access-control-request-headers":
+                    req_headers = value
+                    break
+            headers = self._preflight_headers + [(b"access-control-allow-headers", req_headers)]
+            await send({"type": "http.response.start", "status": 204, "headers": headers})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + self._cors_headers
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
 
 # App setup
 app = FastAPI(title="KEN ASSISTANT API (Final Fixed)")
 
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:8080"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+
+@app.on_event("startup")
+async def startup_http_client():
+    # Warm the shared weather HTTP client so the first lookup doesn't pay
+    # pool-creation cost.
+    init_http_client()
+
+
+@app.on_event("shutdown")
+async def shutdown_http_client():
+    await close_http_client()
+
+app.add_middleware(PureASGICORS, origin="http://localhost:8080")
 
 # -----------------------------------------------------------
 # MODELS
@@ -58,81 +116,46 @@ class ChatDelete(BaseModel):
     chat_id: int
 
 
+# -----------------------------------------------------------
+# HOT-PATH SQL
+# Kept as module constants so the recurring statements live in one place.
+# (Plain cursors on purpose: mysql-connector has no client-side prepared-
+# statement cache, so prepared=True on a per-request cursor costs an
+# extra prepare round-trip per query.)
+# -----------------------------------------------------------
+
+_SQL_HISTORY_LIST = "SELECT id, title FROM chat_titles WHERE user_id=%s ORDER BY updated_at DESC"
+_SQL_LOAD_MESSAGES = "SELECT message, role FROM chats WHERE chat_id=%s ORDER BY created_at ASC"
+# For the LLM we only need the recent turns (the model context is finite
+# anyway); newest-first + LIMIT keeps memory bounded on mature chats.
+# id breaks created_at ties: the TIMESTAMP has one-second resolution, so
+# a user message and its reply can land in the same second.
+_SQL_LOAD_RECENT_MESSAGES = "SELECT message, role FROM chats WHERE chat_id=%s ORDER BY created_at DESC, id DESC LIMIT 40"
+_SQL_INSERT_MESSAGE = "INSERT INTO chats (user_id, chat_id, message, role) VALUES (%s, %s, %s, %s)"
+
+
 # -----------------------------------------------------------
 # HELPERS: Location extraction, followups, auth
 # -----------------------------------------------------------
 
-def extract_location(query: str) -> Optional[str]:
-    """
-    Improved location extraction:
-    - Supports 'weather delhi'
-    - Supports 'weather in th delhi'
-    - Supports 'delhi weather'
-    - Supports typos and multiple-word city names
-    - Fallback: last noun phrase in the sentence
-    """
-    if not query or not isinstance(query, str):
-        return None
-
-    q = query.strip().lower()
-
-    # 1. Strong patterns first
-    patterns = [
-        r"weather in ([\w\s,.'-]+)",
-        r"weather at ([\w\s,.'-]+)",
-        r"temperature in ([\w\s,.'-]+)",
-        r"forecast for ([\w\s,.'-]+)",
-        r"what.*weather in ([\w\s,.'-]+)",
-        r"how.*weather in ([\w\s,.'-]+)",
-        r"current weather in ([\w\s,.'-]+)",
-        r"what's the weather in ([\w\s,.'-]+)",
-        r"weather ([\w\s,.'-]+)",
-        r"temperature ([\w\s,.'-]+)"
-    ]
-
-    for p in patterns:
-        m = re.search(p, q, re.IGNORECASE)
-        if m:
-            loc = m.group(1).strip()
-            loc = re.sub(r"\b(the|at|in|for|near|th)\b", "", loc, flags=re.IGNORECASE).strip()
-            if len(loc) > 2:
-                return loc.title()
-
-    # 2. Reverse pattern: "delhi weather", "mumbai temperature"
-    rev = re.search(r"([\w\s,.'-]+)\s+(weather|temperature|forecast)", q)
-    if rev:
-        loc = rev.group(1).strip()
-        loc = re.sub(r"\b(the|at|in|for|near|th)\b", "", loc, flags=re.IGNORECASE).strip()
-        if len(loc) > 2:
-            return loc.title()
-
-    # 3. Fallback: last word(s) as possible location
-    words = q.split()
-    if len(words) >= 1:
-        for size in [3, 2, 1]:
-            if len(words) >= size:
-                candidate = " ".join(words[-size:])
-                candidate = re.sub(r"\b(the|at|in|for|near|th|is|present)\b", "", candidate).strip()
-                if len(candidate) > 2:
-                    return candidate.title()
-
-    return None
-
-
-
-def is_weather_followup(query: str) -> bool:
-    if not query:
-        return False
-    q = query.lower()
-    weather_terms = ["weather", "temperature", "forecast", "rain", "snow", "wind", "sunrise", "sunset"]
-    followup_terms = ["tomorrow", "day after", "next", "again", "same place", "how about", "what about", "later", "today"]
-    return any(w in q for w in weather_terms) or any(f in q for f in followup_terms)
+# The text helpers live in text_utils.py, which is framework-free and can
+# optionally be Cython-compiled (cythonize -i backend/text_utils.py); the
+# built extension shadows the .py transparently.
+
+# Verified-token cache: HMAC verify + JSON parse runs on every authed
+# request otherwise. The 5-minute TTL bounds how long a token that just
+# expired can still be accepted from the cache. get_current_user_id is a
+# sync dependency, so FastAPI runs it in the threadpool — cachetools
+# containers are not thread-safe, hence the lock around every access.
+_token_cache: TTLCache = TTLCache(maxsize=4096, ttl=300)
+_token_cache_lock = threading.Lock()
 
 
 def get_current_user_id(request: Request):
     """
     Resolve user id from cookie 'access_token' or Authorization header.
     Gives clear errors for: missing, invalid, or expired tokens.
+    Successful verifications are cached briefly, keyed on the raw token.
     """
     # 1) Try cookie first
     token = request.cookies.get("access_token")
@@ -147,7 +170,13 @@ def get_current_user_id(request: Request):
     if not token or token in ("", "null", "undefined"):
         raise HTTPException(status_code=401, detail="Not authenticated: token missing")
 
-    # 4) Decode JWT safely
+    # 4) Cached verification first (single dict probe on repeat requests)
+    with _token_cache_lock:
+        cached_uid = _token_cache.get(token)
+    if cached_uid is not None:
+        return cached_uid
+
+    # 5) Decode JWT safely
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
     except ExpiredSignatureError:
@@ -155,26 +184,22 @@ def get_current_user_id(request: Request):
     except JWTError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
-    # 5) Extract user ID
+    # 6) Extract user ID
     uid = payload.get("sub")
     if not uid:
         raise HTTPException(status_code=401, detail="Invalid token payload: missing 'sub'")
 
-    # 6) Convert to int safely
+    # 7) Convert to int safely, then cache the verified token
     try:
-        return int(uid)
+        uid_int = int(uid)
     except (ValueError, TypeError):
         raise HTTPException(status_code=401, detail="Invalid user id in token")
 
+    with _token_cache_lock:
+        _token_cache[token] = uid_int
+    return uid_int
 
 
-def generate_chat_title(text: str) -> str:
-    if not text:
-        return "New Chat"
-    w = text.split()[:4]
-    t = " ".join(w)
-    return t if len(t) <= 30 else (t[:27] + "...")
-
 
 # -----------------------------------------------------------
 # AUTH ENDPOINTS (unchanged logic)
@@ -187,14 +212,22 @@ async def signup(user: UserCreate):
     conn = get_db_connection()
     cursor = conn.cursor()
     try:
-        cursor.execute("SELECT id FROM users WHERE email=%s OR username=%s", (user.email, user.username))
-        if cursor.fetchone():
-            raise HTTPException(400, "User already exists")
-
-        cursor.execute(
-            "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s)",
-            (user.username, user.email, user.password),
+        # bcrypt takes ~100ms by design; run it in a thread so it never
+        # stalls the event loop (and other in-flight chats).
+        hashed = await asyncio.to_thread(
+            bcrypt.hashpw, user.password.encode(), bcrypt.gensalt(rounds=12)
         )
+
+        # One round-trip: the unique indexes on users.email / users.username
+        # make the old existence SELECT redundant — a duplicate simply
+        # raises IntegrityError.
+        try:
+            cursor.execute(
+                "INSERT INTO users (username, email, password_hash) VALUES (%s, %s, %s)",
+                (user.username, user.email, hashed),
+            )
+        except IntegrityError:
+            raise HTTPException(400, "User already exists")
         conn.commit()
         uid = cursor.lastrowid
 
@@ -225,10 +258,17 @@ async def login(user: UserLogin):
             raise HTTPException(401, "Invalid credentials")
 
         uid, pw = row
-        if isinstance(pw, (bytes, bytearray)):
-            pw = pw.decode()
+        if isinstance(pw, str):
+            pw = pw.encode()
 
-        if user.password != pw:
+        # Verify in a thread for the same reason we hash in one on signup.
+        try:
+            ok = await asyncio.to_thread(bcrypt.checkpw, user.password.encode(), pw)
+        except ValueError:
+            # stored value is not a bcrypt hash (e.g. legacy plaintext row)
+            ok = False
+
+        if not ok:
             raise HTTPException(401, "Invalid credentials")
 
         token = create_access_token(uid)
@@ -272,7 +312,7 @@ async def new_chat(user_id: int = Depends(get_current_user_id)):
 async def history(user_id: int = Depends(get_current_user_id)):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, title FROM chat_titles WHERE user_id=%s ORDER BY updated_at DESC", (user_id,))
+    cursor.execute(_SQL_HISTORY_LIST, (user_id,))
     rows = cursor.fetchall()
     cursor.close()
     conn.close()
@@ -287,45 +327,121 @@ async def get_chat(chat_id: int, user_id: int = Depends(get_current_user_id)):
     title = cursor.fetchone()
     if not title:
         raise HTTPException(404, "Chat not found")
-    cursor.execute("SELECT message, role FROM chats WHERE chat_id=%s ORDER BY created_at ASC", (chat_id,))
+    cursor.execute(_SQL_LOAD_MESSAGES, (chat_id,))
     msgs = [{"role": r[1], "content": r[0]} for r in cursor.fetchall()]
     cursor.close()
     conn.close()
     return {"title": title[0], "messages": msgs}
 
 
+# -----------------------------------------------------------
+# BACKGROUND DB WRITES
+# The assistant-message insert used to run synchronously inside the
+# streaming generator, blocking the event loop right as the response
+# finishes. Writes go through a queue drained by a background task that
+# runs the blocking driver call in a thread.
+# -----------------------------------------------------------
+
+_WRITE_QUEUE: asyncio.Queue = asyncio.Queue()
+_writer_task = None
+
+
+def _sync_insert_message(user_id: int, chat_id: int, message: str, role: str):
+    # Everything inside the try: get_db_connection() returns None on
+    # connection errors, and no failure here may escape into the writer
+    # task — one bad item must cost only its own row (same policy as the
+    # old inline write).
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(_SQL_INSERT_MESSAGE, (user_id, chat_id, message, role))
+            conn.commit()
+        finally:
+            cursor.close()
+            conn.close()
+    except Exception:
+        # swallow DB write errors
+        pass
+
+
+async def _drain_write_queue():
+    while True:
+        item = await _WRITE_QUEUE.get()
+        try:
+            await asyncio.to_thread(_sync_insert_message, *item)
+        except Exception:
+            # belt and braces: the sole consumer must never die
+            pass
+        finally:
+            _WRITE_QUEUE.task_done()
+
+
+@app.on_event("startup")
+async def startup_background_writer():
+    global _writer_task
+    _writer_task = asyncio.create_task(_drain_write_queue())
+
+
+@app.on_event("shutdown")
+async def shutdown_background_writer():
+    # Flush queued assistant messages before exiting so a graceful
+    # restart doesn't drop them, then stop the consumer.
+    await _WRITE_QUEUE.join()
+    if _writer_task is not None:
+        _writer_task.cancel()
+
+
 # -----------------------------------------------------------
 # CHAT STREAM: Corrected WEATHER injection + persistence
 # -----------------------------------------------------------
 
+# The strict system prompt never changes, so build its message dict once
+# at import time instead of re-allocating the string + dict per request.
+_SYSTEM_PROMPT = """
+You are KEN ASSISTANT.
+
+IMPORTANT RULES FOR WEATHER ANSWERS:
+1. When WEATHER_PACKET_JSON is provided, you MUST use ONLY that data.
+2. NEVER guess, assume, or fabricate any weather info.
+3. NEVER use AccuWeather, Google, or any external sources.
+4. ONLY use data explicitly given inside WEATHER_PACKET_JSON.
+5. If something is missing in the packet, say "Weather data unavailable".
+6. Do NOT invent dates, temperatures, humidity, wind speeds, or conditions.
+7. Your weather response MUST be based strictly on WEATHER_PACKET_JSON and/or the human-readable Weather Summary.
+
+Respond clearly, accurately, and in Markdown format.
+"""
+
+_SYS_PREFIX = ({"role": "system", "content": _SYSTEM_PROMPT},)
+
 @app.post("/chat/stream")
 async def stream(msg: ChatMessage, request: Request, user_id: int = Depends(get_current_user_id)):
-    # Validate chat and fetch last_location
+    # Validate chat, save the user message, apply the first-message auto
+    # title and fetch last_location — all in one stored-procedure call
+    # (sp_enter_chat_message, see database/schema.sql) instead of 3-4
+    # sequential round-trips before the stream starts.
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id, last_location FROM chat_titles WHERE id=%s AND user_id=%s", (msg.chat_id, user_id))
-    row = cursor.fetchone()
-    if not row:
+    cursor.callproc(
+        "sp_enter_chat_message",
+        (user_id, msg.chat_id, msg.message, generate_chat_title(msg.message)),
+    )
+    row = None
+    for result in cursor.stored_results():
+        row = result.fetchone()
+    conn.commit()
+    if not row or not row[0]:
         cursor.close()
         conn.close()
         raise HTTPException(404, "Chat not found")
-    chat_id = row[0]
+    chat_id = msg.chat_id
     chat_last_location = row[1]
 
-    # Save user message
-    cursor.execute("INSERT INTO chats (user_id, chat_id, message, role) VALUES (%s, %s, %s, 'user')",
-                   (user_id, chat_id, msg.message))
-    conn.commit()
-
-    # Auto title update for first message
-    cursor.execute("SELECT COUNT(*) FROM chats WHERE chat_id=%s AND role='user'", (chat_id,))
-    if cursor.fetchone()[0] == 1:
-        cursor.execute("UPDATE chat_titles SET title=%s WHERE id=%s", (generate_chat_title(msg.message), chat_id))
-        conn.commit()
-
-    # Load history (we'll inject weather before passing to LLM)
-    cursor.execute("SELECT message, role FROM chats WHERE chat_id=%s ORDER BY created_at ASC", (chat_id,))
-    history = cursor.fetchall()
+    # Load recent history (we'll inject weather before passing to LLM);
+    # re-reverse to chronological order for the prompt.
+    cursor.execute(_SQL_LOAD_RECENT_MESSAGES, (chat_id,))
+    history = list(reversed(cursor.fetchall()))
 
     # Weather handling: extract location or use persisted last_location on follow-ups
     location = extract_location(msg.message)
@@ -334,60 +450,53 @@ async def stream(msg: ChatMessage, request: Request, user_id: int = Depends(get_
 
     weather_summary = None
     weather_packet = None
+    new_location = None
     if location:
         try:
-            res = get_weather_summary_for_prompt(location, forecast_days=5)
+            res = await get_weather_summary_for_prompt(location, forecast_days=5)
             if res:
                 weather_summary = res.get("summary")
                 weather_packet = res.get("packet")
-                # persist last_location (store canonical location string)
-                try:
-                    cursor.execute("UPDATE chat_titles SET last_location=%s WHERE id=%s", (location, chat_id))
-                    conn.commit()
-                except Exception:
-                    # ignore write errors but continue (we still have weather)
-                    pass
+                # persist last_location below (store canonical location string)
+                new_location = location
         except Exception:
             # If weather engine fails, set None and proceed so model sees no weather
             weather_summary = None
             weather_packet = None
 
+    # Persist last_location (the auto title is handled inside the stored
+    # procedure above).
+    if new_location:
+        try:
+            cursor.execute(
+                "UPDATE chat_titles SET last_location=%s WHERE id=%s",
+                (new_location, chat_id),
+            )
+            conn.commit()
+        except Exception:
+            # ignore write errors but continue (we still have weather)
+            pass
+
     # close DB connection before streaming to free connections
     cursor.close()
     conn.close()
 
-    # Build the strict system prompt (triple-quoted to avoid unterminated string issues)
-    system_prompt = """
-You are KEN ASSISTANT.
-
-IMPORTANT RULES FOR WEATHER ANSWERS:
-1. When WEATHER_PACKET_JSON is provided, you MUST use ONLY that data.
-2. NEVER guess, assume, or fabricate any weather info.
-3. NEVER use AccuWeather, Google, or any external sources.
-4. ONLY use data explicitly given inside WEATHER_PACKET_JSON.
-5. If something is missing in the packet, say "Weather data unavailable".
-6. Do NOT invent dates, temperatures, humidity, wind speeds, or conditions.
-7. Your weather response MUST be based strictly on WEATHER_PACKET_JSON and/or the human-readable Weather Summary.
-
-Respond clearly, accurately, and in Markdown format.
-"""
-
     # Build messages in the correct order:
-    # 1) system prompt (rules)
+    # 1) system prompt (rules, pre-built module constant)
     # 2) weather summary (human-friendly) and code-fenced JSON packet (if available)
     # 3) conversation history
     # 4) current user message
-    messages = []
-    messages.append({"role": "system", "content": system_prompt})
+    messages = [*_SYS_PREFIX]
 
     if weather_summary and weather_packet:
         # Human readable summary
         messages.append({"role": "system", "content": f"Weather summary for {location}: {weather_summary}"})
 
-        # Code-fenced JSON to make parsing reliable
-        try:
-            packet_json = json.dumps(weather_packet, indent=2, default=str)
-        except Exception:
+        # Code-fenced JSON to make parsing reliable; the weather engine
+        # pre-renders the packet with orjson, so normally no serialization
+        # happens here at all.
+        packet_json = weather_packet.get("_json")
+        if not packet_json:
             packet_json = json.dumps(weather_packet, default=str)
 
         messages.append({
@@ -424,26 +533,27 @@ Respond clearly, accurately, and in Markdown format.
                         yield f"❌ LLM model error: {txt}"
                         return
 
-                    async for chunk in resp.aiter_bytes():
+                    # Ollama streams newline-delimited JSON; aiter_lines()
+                    # buffers across chunk boundaries so we never parse a
+                    # line split mid-token, and orjson is much faster than
+                    # stdlib json for these small per-token objects.
+                    async for line in resp.aiter_lines():
                         if await request.is_disconnected():
                             cancelled = True
                             break
 
-                        text = chunk.decode("utf-8", errors="ignore")
-                        # Ollama streaming may give newline-delimited JSON lines
-                        for line in text.split("\n"):
-                            if not line.strip():
-                                continue
-                            try:
-                                j = json.loads(line)
-                                token = j.get("message", {}).get("content", "")
-                                if token:
-                                    full_response += token
-                                    yield token
-                            except Exception:
-                                # Fallback: stream raw text if parsing fails
-                                full_response += line
-                                yield line
+                        if not line.strip():
+                            continue
+                        try:
+                            j = orjson.loads(line)
+                            token = j.get("message", {}).get("content", "")
+                            if token:
+                                full_response += token
+                                yield token
+                        except Exception:
+                            # Fallback: stream raw text if parsing fails
+                            full_response += line
+                            yield line
 
             except httpx.RequestError as e:
                 yield f"Network error: {str(e)}"
@@ -452,22 +562,10 @@ Respond clearly, accurately, and in Markdown format.
                 yield f"Unexpected error: {str(e)}"
                 return
 
-        # Save assistant response if not cancelled
+        # Save assistant response if not cancelled; the background writer
+        # does the blocking insert so the stream can finish immediately.
         if not cancelled:
-            conn2 = get_db_connection()
-            cur2 = conn2.cursor()
-            try:
-                cur2.execute(
-                    "INSERT INTO chats (user_id, chat_id, message, role) VALUES (%s, %s, %s, 'assistant')",
-                    (user_id, msg.chat_id, full_response),
-                )
-                conn2.commit()
-            except Exception:
-                # swallow DB write errors
-                pass
-            finally:
-                cur2.close()
-                conn2.close()
+            await _WRITE_QUEUE.put((user_id, msg.chat_id, full_response, "assistant"))
 
     return StreamingResponse(generate(), media_type="text/plain")
 
@@ -495,13 +593,14 @@ async def rename(chat: ChatRename, user_id: int = Depends(get_current_user_id)):
 async def delete(chat: ChatDelete, user_id: int = Depends(get_current_user_id)):
     conn = get_db_connection()
     cursor = conn.cursor()
-    cursor.execute("SELECT id FROM chat_titles WHERE id=%s AND user_id=%s", (chat.chat_id, user_id))
-    if not cursor.fetchone():
+    # Ownership check folded into the DELETE itself; rowcount tells us
+    # whether anything matched, saving the pre-SELECT round-trip.
+    cursor.execute("DELETE FROM chat_titles WHERE id=%s AND user_id=%s", (chat.chat_id, user_id))
+    conn.commit()
+    if cursor.rowcount == 0:
         cursor.close()
         conn.close()
         raise HTTPException(404, "Chat not found")
-    cursor.execute("DELETE FROM chat_titles WHERE id=%s", (chat.chat_id,))
-    conn.commit()
     cursor.close()
     conn.close()
     return {"status": "ok"}
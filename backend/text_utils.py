@@ -0,0 +1,118 @@
+# text_utils.py
+"""
+Pure-Python text helpers for the chat pipeline (location extraction,
+weather follow-up detection, auto chat titles).
+
+Kept free of framework imports so the module can optionally be compiled
+with Cython for an interpreter-overhead win on the per-turn hot path:
+
+    cythonize -i backend/text_utils.py
+
+The built extension module shadows this file automatically; nothing else
+needs the build to exist.
+"""
+
+import re
+from functools import lru_cache
+from typing import Optional
+
+# Prefer google-re2 when it's installed: RE2 executes in linear time, so
+# adversarial queries can't trigger the super-linear backtracking the
+# stdlib engine allows, and it's typically faster on short strings too.
+# Entirely optional — stdlib re is the fallback.
+try:
+    import re2 as _re_engine  # pip install google-re2
+except ImportError:
+    _re_engine = re
+
+
+def _compile(pattern: str):
+    try:
+        return _re_engine.compile(pattern, _re_engine.IGNORECASE)
+    except Exception:
+        # re2 rejects constructs it can't run in linear time; keep the
+        # stdlib-compiled pattern for those.
+        return re.compile(pattern, re.IGNORECASE)
+
+
+# Location patterns are compiled once at import time: extract_location runs on
+# every chat turn and re-compiling (or re-looking-up) the patterns per call is
+# wasted work on the hot /chat/stream path.
+#
+# A single alternation covers both the forward forms ("weather in delhi",
+# "current weather delhi", "forecast for mumbai") and the reverse form
+# ("delhi weather") so one search() call replaces the old loop over ten
+# near-identical patterns. Searching is unanchored, so prefixes like
+# "what's the" before the keyword still match. The reverse branch is
+# anchored at end-of-string (modulo trailing punctuation, so "delhi
+# weather?" still matches) to keep forward forms winning over it.
+_LOC_COMBINED = _compile(
+    r"(?:(?:current\s+)?(?:weather|temperature|forecast)(?:\s+(?:in|at|for))?\s+(?P<fwd>[\w\s,.'-]+))"
+    r"|(?P<rev>[\w\s,.'-]+?)\s+(?:weather|temperature|forecast)[\s?.!]*$"
+)
+
+_STOPWORDS_RE = _compile(r"\b(the|at|in|for|near|th)\b")
+_STOPWORDS_FALLBACK_RE = _compile(r"\b(the|at|in|for|near|th|is|present)\b")
+
+
+def extract_location(query: str) -> Optional[str]:
+    """
+    Improved location extraction:
+    - Supports 'weather delhi'
+    - Supports 'weather in th delhi'
+    - Supports 'delhi weather'
+    - Supports typos and multiple-word city names
+    - Fallback: last noun phrase in the sentence
+
+    Pure function of the normalized query, so results are memoized:
+    follow-up turns repeating the same phrasing cost one dict probe.
+    """
+    if not query or not isinstance(query, str):
+        return None
+
+    return _extract_location_cached(query.strip().lower())
+
+
+@lru_cache(maxsize=1024)
+def _extract_location_cached(q: str) -> Optional[str]:
+    # 1. Single combined pattern: forward ("weather in delhi") or reverse
+    #    ("delhi weather") in one engine invocation.
+    m = _LOC_COMBINED.search(q)
+    if m:
+        loc = (m.group("fwd") or m.group("rev")).strip()
+        loc = _STOPWORDS_RE.sub("", loc).strip()
+        if len(loc) > 2:
+            return loc.title()
+
+    # 2. Fallback: last word(s) as possible location
+    words = q.split()
+    if len(words) >= 1:
+        for size in [3, 2, 1]:
+            if len(words) >= size:
+                candidate = " ".join(words[-size:])
+                candidate = _STOPWORDS_FALLBACK_RE.sub("", candidate).strip()
+                if len(candidate) > 2:
+                    return candidate.title()
+
+    return None
+
+
+def is_weather_followup(query: str) -> bool:
+    if not query:
+        return False
+    return _is_weather_followup_cached(query.lower())
+
+
+@lru_cache(maxsize=1024)
+def _is_weather_followup_cached(q: str) -> bool:
+    weather_terms = ["weather", "temperature", "forecast", "rain", "snow", "wind", "sunrise", "sunset"]
+    followup_terms = ["tomorrow", "day after", "next", "again", "same place", "how about", "what about", "later", "today"]
+    return any(w in q for w in weather_terms) or any(f in q for f in followup_terms)
+
+
+def generate_chat_title(text: str) -> str:
+    if not text:
+        return "New Chat"
+    w = text.split()[:4]
+    t = " ".join(w)
+    return t if len(t) <= 30 else (t[:27] + "...")
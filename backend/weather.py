@@ -12,25 +12,74 @@ load_dotenv()
 
 import os
 import time
-import requests
-from typing import Optional, Dict, Any, List, Tuple
+import asyncio
+import httpx
+import orjson
+import numpy as np
+from cachetools import LRUCache, TTLCache
+from collections import Counter, defaultdict
+from typing import Optional, Dict, Any, List
 
 OWM_KEY = os.getenv("WEATHER_API_KEY")
 
-# Separate caches (cleaner & safer)
-_geo_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
-_current_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
-_forecast_cache: Dict[str, Tuple[List[Dict[str, Any]], float]] = {}
-_aqi_cache: Dict[str, Tuple[Dict[str, Any], float]] = {}
-
 # TTLs
 GEO_TTL = 24 * 3600       # 24 hours
 CURRENT_TTL = 5 * 60      # 5 min
 FORECAST_TTL = 10 * 60    # 10 min
 AQI_TTL = 60 * 60         # 1 hour
 
+# Separate caches (cleaner & safer), all bounded so a long-running server
+# with varied locations can't grow them indefinitely.
+#
+# The geocode and AQI caches are keyed on (key, time bucket) instead of
+# storing a timestamp per entry: when the monotonic bucket rolls over the
+# lookup simply misses the stale key, so the hit path is a single dict
+# probe with no time.time() call or TTL subtraction — LRU eviction alone
+# bounds them. (lru_cache would be the usual tool here, but it cannot
+# wrap async functions.) Current and forecast use TTLCache, which evicts
+# on both age and size.
+_CACHE_MAXSIZE = 8192
+_geo_cache: LRUCache = LRUCache(maxsize=_CACHE_MAXSIZE)
+_current_cache: TTLCache = TTLCache(maxsize=_CACHE_MAXSIZE, ttl=CURRENT_TTL)
+_forecast_cache: TTLCache = TTLCache(maxsize=_CACHE_MAXSIZE, ttl=FORECAST_TTL)
+_aqi_cache: LRUCache = LRUCache(maxsize=_CACHE_MAXSIZE)
+
+
+def _ttl_bucket(ttl: int) -> int:
+    return int(time.monotonic() // ttl)
+
 HEADERS = {"User-Agent": "KEN-Assistant-Weather/1.0"}
 
+# Shared async HTTP client: one connection pool with keepalive (and HTTP/2
+# when the server supports it) instead of a fresh TCP+TLS handshake per
+# OpenWeatherMap call. Created lazily / on app startup, closed on shutdown.
+_HTTPX: Optional[httpx.AsyncClient] = None
+
+
+def init_http_client() -> httpx.AsyncClient:
+    global _HTTPX
+    if _HTTPX is None:
+        kwargs = dict(
+            timeout=10,
+            headers=HEADERS,
+            limits=httpx.Limits(max_keepalive_connections=20),
+        )
+        try:
+            # HTTP/2 needs the optional h2 package (httpx[http2]); fall
+            # back to HTTP/1.1 keepalive when it isn't installed rather
+            # than crashing the startup hook.
+            _HTTPX = httpx.AsyncClient(http2=True, **kwargs)
+        except ImportError:
+            _HTTPX = httpx.AsyncClient(**kwargs)
+    return _HTTPX
+
+
+async def close_http_client():
+    global _HTTPX
+    if _HTTPX is not None:
+        await _HTTPX.aclose()
+        _HTTPX = None
+
 
 def _now_ts() -> float:
     return time.time()
@@ -39,22 +88,21 @@ def _now_ts() -> float:
 # --------------------------------------------------------
 # GEOCODING
 # --------------------------------------------------------
-def geocode_location(location: str) -> Optional[Dict[str, Any]]:
+async def geocode_location(location: str) -> Optional[Dict[str, Any]]:
     if not OWM_KEY:
         return None
 
-    key = location.strip().lower()
+    key = (location.strip().lower(), _ttl_bucket(GEO_TTL))
 
     cached = _geo_cache.get(key)
-    if cached and _now_ts() - cached[1] < GEO_TTL:
-        return cached[0]
+    if cached is not None:
+        return cached
 
     try:
-        r = requests.get(
+        r = await init_http_client().get(
             "http://api.openweathermap.org/geo/1.0/direct",
             params={"q": location, "limit": 1, "appid": OWM_KEY},
-            timeout=8,
-            headers=HEADERS
+            timeout=8
         )
 
         if r.status_code != 200:
@@ -73,7 +121,7 @@ def geocode_location(location: str) -> Optional[Dict[str, Any]]:
             "state": top.get("state"),
         }
 
-        _geo_cache[key] = (result, _now_ts())
+        _geo_cache[key] = result
         return result
 
     except Exception:
@@ -83,21 +131,20 @@ def geocode_location(location: str) -> Optional[Dict[str, Any]]:
 # --------------------------------------------------------
 # CURRENT WEATHER
 # --------------------------------------------------------
-def _fetch_current_weather_by_coord(lat: float, lon: float) -> Optional[Dict[str, Any]]:
+async def _fetch_current_weather_by_coord(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     if not OWM_KEY:
         return None
 
     key = f"cur:{lat:.4f},{lon:.4f}"
     cached = _current_cache.get(key)
-    if cached and _now_ts() - cached[1] < CURRENT_TTL:
-        return cached[0]
+    if cached is not None:
+        return cached
 
     try:
-        r = requests.get(
+        r = await init_http_client().get(
             "https://api.openweathermap.org/data/2.5/weather",
             params={"lat": lat, "lon": lon, "appid": OWM_KEY, "units": "metric"},
-            timeout=8,
-            headers=HEADERS
+            timeout=8
         )
 
         if r.status_code != 200:
@@ -117,7 +164,18 @@ def _fetch_current_weather_by_coord(lat: float, lon: float) -> Optional[Dict[str
             "clouds_pct": d.get("clouds", {}).get("all"),
         }
 
-        _current_cache[key] = (res, _now_ts())
+        # Pre-format the prompt line once here so cache hits (the common
+        # case within the TTL) skip the f-string work entirely.
+        res["_line"] = (
+            f"Current: {res['description'] or 'N/A'}, "
+            f"{res['temp_c'] if res['temp_c'] is not None else 'N/A'}°C "
+            f"(feels like {res['feels_like_c'] if res['feels_like_c'] is not None else 'N/A'}°C) | "
+            f"Humidity: {res['humidity'] if res['humidity'] is not None else 'N/A'}% | "
+            f"Wind: {res['wind_speed_m_s'] if res['wind_speed_m_s'] is not None else 'N/A'} m/s | "
+            f"Clouds: {res['clouds_pct'] if res['clouds_pct'] is not None else 'N/A'}%"
+        )
+
+        _current_cache[key] = res
         return res
 
     except Exception:
@@ -127,21 +185,20 @@ def _fetch_current_weather_by_coord(lat: float, lon: float) -> Optional[Dict[str
 # --------------------------------------------------------
 # FORECAST (DAILY AGGREGATE)
 # --------------------------------------------------------
-def _fetch_forecast_by_coord(lat: float, lon: float, days: int = 5) -> Optional[List[Dict[str, Any]]]:
+async def _fetch_forecast_by_coord(lat: float, lon: float, days: int = 5) -> Optional[List[Dict[str, Any]]]:
     if not OWM_KEY:
         return None
 
     key = f"fc:{lat:.4f},{lon:.4f}:{days}"
     cached = _forecast_cache.get(key)
-    if cached and _now_ts() - cached[1] < FORECAST_TTL:
-        return cached[0]
+    if cached is not None:
+        return cached
 
     try:
-        r = requests.get(
+        r = await init_http_client().get(
             "https://api.openweathermap.org/data/2.5/forecast",
             params={"lat": lat, "lon": lon, "appid": OWM_KEY, "units": "metric"},
-            timeout=10,
-            headers=HEADERS
+            timeout=10
         )
 
         if r.status_code != 200:
@@ -149,39 +206,63 @@ def _fetch_forecast_by_coord(lat: float, lon: float, days: int = 5) -> Optional[
 
         d = r.json()
         items = d.get("list", [])
+        if not items:
+            return None
 
-        daily = {}
-        for it in items:
-            ts = it.get("dt")
-            day_str = time.strftime("%Y-%m-%d", time.gmtime(ts))
-
-            slot = daily.setdefault(day_str, {"temps": [], "desc": [], "winds": [], "hum": []})
-            main = it.get("main", {})
-
-            slot["temps"].append(main.get("temp"))
-            slot["desc"].append(it.get("weather", [{}])[0].get("description"))
-            slot["winds"].append(it.get("wind", {}).get("speed"))
-            slot["hum"].append(main.get("humidity"))
+        # Vectorized daily aggregation: load the ~40 forecast slots into
+        # numpy arrays once (missing values become NaN) and reduce per day
+        # group in C instead of Python-level min/max/sum loops.
+        def _to_float(v):
+            return float(v) if v is not None else np.nan
+
+        n = len(items)
+        days_arr = np.array([time.strftime("%Y-%m-%d", time.gmtime(it.get("dt"))) for it in items])
+        temps = np.fromiter((_to_float(it.get("main", {}).get("temp")) for it in items), dtype=np.float64, count=n)
+        winds = np.fromiter((_to_float(it.get("wind", {}).get("speed")) for it in items), dtype=np.float64, count=n)
+        hums = np.fromiter((_to_float(it.get("main", {}).get("humidity")) for it in items), dtype=np.float64, count=n)
+        # np.unique returns the sorted day strings plus a group id per slot
+        unique_days, group_ids = np.unique(days_arr, return_inverse=True)
+
+        # Descriptions are strings, so they stay in Python — but group them
+        # in a single pass over the slots (defaultdict of Counters keyed by
+        # group id) rather than re-scanning the whole list for every day.
+        descs_by_group: Dict[int, Counter] = defaultdict(Counter)
+        for g, it in zip(group_ids, items):
+            desc = it.get("weather", [{}])[0].get("description")
+            if desc:
+                descs_by_group[int(g)][desc] += 1
+
+        def _stat(arr: np.ndarray, reducer) -> Optional[float]:
+            valid = arr[~np.isnan(arr)]
+            return float(reducer(valid)) if valid.size else None
 
         result = []
-        for day in sorted(daily.keys())[:days]:
-            e = daily[day]
-
-            temps = [t for t in e["temps"] if t is not None]
-            winds = [w for w in e["winds"] if w is not None]
-            hums =  [h for h in e["hum"] if h is not None]
-
-            result.append({
-                "date": day,
-                "temp_min_c": min(temps) if temps else None,
-                "temp_max_c": max(temps) if temps else None,
-                "temp_avg_c": sum(temps)/len(temps) if temps else None,
-                "common_description": max(set(e["desc"]), key=e["desc"].count) if e["desc"] else None,
-                "wind_avg_m_s": sum(winds)/len(winds) if winds else None,
-                "humidity_avg": sum(hums)/len(hums) if hums else None,
-            })
-
-        _forecast_cache[key] = (result, _now_ts())
+        for g, day in enumerate(unique_days[:days]):
+            mask = group_ids == g
+            day_temps = temps[mask]
+            day_winds = winds[mask]
+            day_hums = hums[mask]
+            day_descs = descs_by_group.get(g)
+
+            entry = {
+                "date": str(day),
+                "temp_min_c": _stat(day_temps, np.min),
+                "temp_max_c": _stat(day_temps, np.max),
+                "temp_avg_c": _stat(day_temps, np.mean),
+                "common_description": day_descs.most_common(1)[0][0] if day_descs else None,
+                "wind_avg_m_s": _stat(day_winds, np.mean),
+                "humidity_avg": _stat(day_hums, np.mean),
+            }
+            # Pre-formatted prompt line, so format_packet_for_prompt does
+            # no per-day string work on cache hits.
+            entry["_line"] = (
+                f"{entry['date']}: {entry['common_description'] or 'N/A'}, "
+                f"{entry['temp_min_c'] if entry['temp_min_c'] is not None else 'N/A'}°C - "
+                f"{entry['temp_max_c'] if entry['temp_max_c'] is not None else 'N/A'}°C"
+            )
+            result.append(entry)
+
+        _forecast_cache[key] = result
         return result
 
     except Exception:
@@ -191,21 +272,20 @@ def _fetch_forecast_by_coord(lat: float, lon: float, days: int = 5) -> Optional[
 # --------------------------------------------------------
 # AIR QUALITY
 # --------------------------------------------------------
-def _fetch_aqi_by_coord(lat: float, lon: float) -> Optional[Dict[str, Any]]:
+async def _fetch_aqi_by_coord(lat: float, lon: float) -> Optional[Dict[str, Any]]:
     if not OWM_KEY:
         return None
 
-    key = f"aqi:{lat:.4f},{lon:.4f}"
+    key = (f"aqi:{lat:.4f},{lon:.4f}", _ttl_bucket(AQI_TTL))
     cached = _aqi_cache.get(key)
-    if cached and _now_ts() - cached[1] < AQI_TTL:
-        return cached[0]
+    if cached is not None:
+        return cached
 
     try:
-        r = requests.get(
+        r = await init_http_client().get(
             "http://api.openweathermap.org/data/2.5/air_pollution",
             params={"lat": lat, "lon": lon, "appid": OWM_KEY},
-            timeout=8,
-            headers=HEADERS
+            timeout=8
         )
 
         if r.status_code != 200:
@@ -219,7 +299,7 @@ def _fetch_aqi_by_coord(lat: float, lon: float) -> Optional[Dict[str, Any]]:
                 "components": el.get("components", {})
             }
 
-            _aqi_cache[key] = (result, _now_ts())
+            _aqi_cache[key] = result
             return result
 
         return None
@@ -231,11 +311,25 @@ def _fetch_aqi_by_coord(lat: float, lon: float) -> Optional[Dict[str, Any]]:
 # --------------------------------------------------------
 # FINAL PACKET
 # --------------------------------------------------------
-def build_weather_packet(location: str, forecast_days: int = 5) -> Optional[Dict[str, Any]]:
+def _public_view(packet: Dict[str, Any]) -> Dict[str, Any]:
+    """Shallow copy of the packet without internal _-prefixed fields
+    (pre-formatted prompt lines etc.), for serialization into the LLM
+    prompt."""
+    out = {k: v for k, v in packet.items() if not k.startswith("_")}
+    if out.get("current"):
+        out["current"] = {k: v for k, v in out["current"].items() if not k.startswith("_")}
+    if out.get("forecast"):
+        out["forecast"] = [
+            {k: v for k, v in day.items() if not k.startswith("_")} for day in out["forecast"]
+        ]
+    return out
+
+
+async def build_weather_packet(location: str, forecast_days: int = 5) -> Optional[Dict[str, Any]]:
     if not location:
         return None
 
-    geo = geocode_location(location)
+    geo = await geocode_location(location)
     if not geo:
         return None
 
@@ -243,11 +337,15 @@ def build_weather_packet(location: str, forecast_days: int = 5) -> Optional[Dict
     if lat is None or lon is None:
         return None
 
-    current = _fetch_current_weather_by_coord(lat, lon)
-    forecast = _fetch_forecast_by_coord(lat, lon, days=forecast_days)
-    aqi = _fetch_aqi_by_coord(lat, lon)
+    # The three lookups are independent, so run them concurrently instead
+    # of paying three serial round-trips.
+    current, forecast, aqi = await asyncio.gather(
+        _fetch_current_weather_by_coord(lat, lon),
+        _fetch_forecast_by_coord(lat, lon, days=forecast_days),
+        _fetch_aqi_by_coord(lat, lon),
+    )
 
-    return {
+    packet = {
         "location": geo.get("name") or location,
         "country": geo.get("country"),
         "state": geo.get("state"),
@@ -258,6 +356,13 @@ def build_weather_packet(location: str, forecast_days: int = 5) -> Optional[Dict
         "aqi": aqi,
         "fetched_at": _now_ts(),
     }
+    # Serialize once here with orjson so main.py can inject pre-rendered
+    # JSON into the prompt instead of calling json.dumps per request; the
+    # internal _line fields stay out of what the model sees.
+    packet["_json"] = orjson.dumps(
+        _public_view(packet), option=orjson.OPT_INDENT_2, default=str
+    ).decode()
+    return packet
 
 
 # --------------------------------------------------------
@@ -274,16 +379,8 @@ def format_packet_for_prompt(packet: Dict[str, Any]) -> str:
     lines.append(f"{loc}{', ' + country if country else ''}")
 
     cur = packet.get("current") or {}
-    if cur:
-        lines.append(
-            f"Current: {cur.get('description','N/A')}, "
-            f"{cur.get('temp_c','N/A')}°C (feels like {cur.get('feels_like_c','N/A')}°C)"
-        )
-        lines.append(
-            f"Humidity: {cur.get('humidity','N/A')}% | "
-            f"Wind: {cur.get('wind_speed_m_s','N/A')} m/s | "
-            f"Clouds: {cur.get('clouds_pct','N/A')}%"
-        )
+    if cur and cur.get("_line"):
+        lines.append(cur["_line"])
 
     aqi = packet.get("aqi")
     if aqi:
@@ -292,11 +389,7 @@ def format_packet_for_prompt(packet: Dict[str, Any]) -> str:
         lines.append(f"AQI: {aqi_val} ({aqi_text})")
 
     fc = packet.get("forecast") or []
-    for day in fc[:3]:
-        lines.append(
-            f"{day.get('date')}: {day.get('common_description','N/A')}, "
-            f"{day.get('temp_min_c','N/A')}°C - {day.get('temp_max_c','N/A')}°C"
-        )
+    lines.extend(day["_line"] for day in fc[:3] if day.get("_line"))
 
     return " | ".join(lines)
 
@@ -304,8 +397,8 @@ def format_packet_for_prompt(packet: Dict[str, Any]) -> str:
 # --------------------------------------------------------
 # UTILITY FOR MAIN.PY
 # --------------------------------------------------------
-def get_weather_summary_for_prompt(location: str, forecast_days: int = 5) -> Optional[Dict[str, Any]]:
-    pkt = build_weather_packet(location, forecast_days)
+async def get_weather_summary_for_prompt(location: str, forecast_days: int = 5) -> Optional[Dict[str, Any]]:
+    pkt = await build_weather_packet(location, forecast_days)
     if not pkt:
         return None
 
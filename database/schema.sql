@@ -45,3 +45,38 @@ CREATE TABLE IF NOT EXISTS password_reset_tokens (
 CREATE INDEX IF NOT EXISTS idx_chats_chatid ON chats (chat_id);
 CREATE INDEX IF NOT EXISTS idx_chats_userid ON chats (user_id);
 CREATE INDEX IF NOT EXISTS idx_chat_titles_userid ON chat_titles (user_id);
+
+-- Single round-trip entry point for /chat/stream: validates chat ownership,
+-- inserts the user message, and applies the first-message auto title, then
+-- returns (found, last_location). Replaces 3-4 sequential round-trips from
+-- the backend before the LLM stream starts.
+DROP PROCEDURE IF EXISTS sp_enter_chat_message;
+DELIMITER //
+CREATE PROCEDURE sp_enter_chat_message(
+    IN p_user_id INT,
+    IN p_chat_id INT,
+    IN p_message TEXT,
+    IN p_title VARCHAR(100)
+)
+BEGIN
+    DECLARE v_location VARCHAR(100) DEFAULT NULL;
+    DECLARE v_title VARCHAR(100) DEFAULT NULL;
+    DECLARE v_found INT DEFAULT 0;
+
+    SELECT last_location, title, 1 INTO v_location, v_title, v_found
+    FROM chat_titles
+    WHERE id = p_chat_id AND user_id = p_user_id;
+
+    IF v_found = 1 THEN
+        INSERT INTO chats (user_id, chat_id, message, role)
+        VALUES (p_user_id, p_chat_id, p_message, 'user');
+
+        -- A still-default title means this is the first user message
+        IF v_title = 'New Chat' THEN
+            UPDATE chat_titles SET title = p_title WHERE id = p_chat_id;
+        END IF;
+    END IF;
+
+    SELECT v_found AS found, v_location AS last_location;
+END //
+DELIMITER ;